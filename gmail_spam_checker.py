@@ -1,28 +1,55 @@
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from googleapiclient.http import build_http
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 import time
 import os
 import logging
+import json
+import re
+import threading
 from spam_classifier import SpamClassifier
 
 SCOPES = ["https://www.googleapis.com/auth/gmail.modify"]
 CREDENTIALS_FILE = 'credentials.json'
 TOKEN_FILE = 'token.json'
+PROCESSED_IDS_FILE = 'processed_ids.json'
 PROCESSED_LABEL_NAME = 'ML_PROCESSED'
 POLL_INTERVAL_SECONDS = 60
+GMAIL_BATCH_SIZE = 50
+# Caps the messages fetched and classified per cycle to stay within the per-user rate limit.
+MAX_MESSAGES_PER_CYCLE = 100
+BACKLOG_DELAY_SECONDS = 5
+BATCH_MODIFY_MAX_IDS = 1000
+LABEL_UPDATE_WORKERS = 8
+# Set both to use Gmail push notifications via Cloud Pub/Sub instead of polling, e.g.
+# 'projects/<project>/topics/<topic>' and 'projects/<project>/subscriptions/<subscription>'.
+PUBSUB_TOPIC = None
+PUBSUB_SUBSCRIPTION = None
+WATCH_RENEWAL_SECONDS = 24 * 60 * 60
 SPAM_CONFIDENCE_THRESHOLD = 0.95
 TRUSTED_DOMAINS = [
     '@google.com', '@gmail.com', '@github.com', '@microsoft.com', '@amazon.com'
 ]
+_TRUSTED_RE = re.compile('|'.join(re.escape(domain) for domain in TRUSTED_DOMAINS), re.IGNORECASE)
+SPAM_TLDS = ['.xyz', '.top', '.click']
+URL_SHORTENERS = ['bit.ly', 'tinyurl.com', 'goo.su']
+_SPAM_SENDER_RE = re.compile(
+    r'@[^\s>]*(?:' + '|'.join(re.escape(tld) for tld in SPAM_TLDS) + r')(?=[\s>]|$)', re.IGNORECASE
+)
+_SHORTENER_RE = re.compile('|'.join(re.escape(domain) for domain in URL_SHORTENERS), re.IGNORECASE)
 
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
 )
 
+_thread_local = threading.local()
+
 
 def get_credentials() -> Credentials | None:
     """Handles user authentication and token management."""
@@ -48,6 +75,14 @@ def get_credentials() -> Credentials | None:
     return creds
 
 
+def build_gmail_service(creds: Credentials):
+    """
+    Builds a Gmail service whose requests share one persistent, authorized connection.
+    build_http() keeps the client's default socket timeout and redirect handling.
+    """
+    return build('gmail', 'v1', http=AuthorizedHttp(creds, http=build_http()))
+
+
 def ensure_processed_label(service) -> str | None:
     """Checks if the 'processed' label exists and creates it if not."""
     try:
@@ -82,6 +117,258 @@ def modify_message_labels(service, msg_id: str, labels_to_add: list, labels_to_r
         logging.error(f"Failed to modify labels for message {msg_id}: {e}")
 
 
+def batch_modify_message_labels(service, msg_ids: list, labels_to_add: list, labels_to_remove: list):
+    """Applies the same label changes to several messages, up to BATCH_MODIFY_MAX_IDS per request."""
+    for start in range(0, len(msg_ids), BATCH_MODIFY_MAX_IDS):
+        chunk = msg_ids[start:start + BATCH_MODIFY_MAX_IDS]
+        try:
+            service.users().messages().batchModify(
+                userId='me',
+                body={'ids': chunk, 'addLabelIds': labels_to_add, 'removeLabelIds': labels_to_remove}
+            ).execute()
+        except HttpError as e:
+            logging.error(f"Failed to modify labels for {len(chunk)} message(s): {e}")
+
+
+def get_thread_service(creds: Credentials):
+    """Returns a Gmail service owned by the calling thread, as the client is not thread-safe."""
+    if not hasattr(_thread_local, 'service'):
+        _thread_local.service = build_gmail_service(creds)
+    return _thread_local.service
+
+
+def submit_label_update(executor: ThreadPoolExecutor, creds: Credentials, msg_ids: list,
+                        labels_to_add: list, labels_to_remove: list) -> Future:
+    """Applies label changes on a background thread so classification is not held up."""
+    def update():
+        batch_modify_message_labels(get_thread_service(creds), msg_ids, labels_to_add, labels_to_remove)
+
+    return executor.submit(update)
+
+
+def wait_for_label_updates(futures: list):
+    """Blocks until pending label updates finish, logging any that failed."""
+    for future in wait(futures).done:
+        if future.exception() is not None:
+            logging.error(f"Label update failed: {future.exception()}")
+
+
+def load_processed_ids() -> set:
+    """Loads the ids of trusted messages that were handled without applying the processed label."""
+    if not os.path.exists(PROCESSED_IDS_FILE):
+        return set()
+    try:
+        with open(PROCESSED_IDS_FILE) as f:
+            return set(json.load(f))
+    except (OSError, ValueError) as e:
+        logging.error(f"Failed to load processed message ids: {e}")
+        return set()
+
+
+def save_processed_ids(processed_ids: set):
+    """Persists the ids of locally processed messages."""
+    try:
+        with open(PROCESSED_IDS_FILE, 'w') as f:
+            json.dump(sorted(processed_ids), f)
+    except OSError as e:
+        logging.error(f"Failed to save processed message ids: {e}")
+
+
+def list_new_messages(service) -> list:
+    """Lists every unread message without the processed label, following pagination."""
+    query = f'is:unread -label:{PROCESSED_LABEL_NAME}'
+    messages = []
+    request = service.users().messages().list(userId='me', q=query, maxResults=500)
+    while request is not None:
+        response = request.execute()
+        messages.extend(response.get('messages', []))
+        request = service.users().messages().list_next(request, response)
+    return messages
+
+
+def fetch_message_metadata(service, msg_ids: list) -> list:
+    """Fetches the metadata of several messages using batched HTTP requests."""
+    emails = []
+
+    def on_message(request_id, response, exception):
+        if exception is not None:
+            logging.error(f"Failed to fetch message {request_id}: {exception}")
+        else:
+            emails.append(response)
+
+    for start in range(0, len(msg_ids), GMAIL_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=on_message)
+        for msg_id in msg_ids[start:start + GMAIL_BATCH_SIZE]:
+            batch.add(
+                service.users().messages().get(userId='me', id=msg_id, format='metadata'),
+                request_id=msg_id
+            )
+        batch.execute()
+
+    return emails
+
+
+def is_obvious_spam(sender: str, snippet: str) -> bool:
+    """Flags mail from known-bad TLDs, or unsubscribe-style mail linking through URL shorteners."""
+    if _SPAM_SENDER_RE.search(sender):
+        return True
+    return bool(_SHORTENER_RE.search(snippet)) and 'unsubscribe' in snippet.lower()
+
+
+def process_new_messages(service, classifier: SpamClassifier, processed_label_id: str,
+                         executor: ThreadPoolExecutor, creds: Credentials, processed_ids: set) -> tuple:
+    """
+    Fetches unread, unprocessed messages, classifies them, and takes action.
+    Trusted messages are recorded in `processed_ids` instead of being labelled.
+    At most MAX_MESSAGES_PER_CYCLE messages are handled per call.
+    Returns the futures of the label updates, which run in the background, and
+    the number of messages left for a later cycle.
+    """
+    listed = list_new_messages(service)
+    listed_ids = {msg['id'] for msg in listed}
+    # Ids that no longer match the query (read, labelled or deleted) need not be remembered.
+    changed = not processed_ids <= listed_ids
+    processed_ids.intersection_update(listed_ids)
+    messages = [msg for msg in listed if msg['id'] not in processed_ids]
+
+    remaining = max(0, len(messages) - MAX_MESSAGES_PER_CYCLE)
+    messages = messages[:MAX_MESSAGES_PER_CYCLE]
+
+    if not messages:
+        logging.info("No new unread messages. Waiting...")
+    elif remaining:
+        logging.info(f"Found {len(messages) + remaining} new message(s); processing {len(messages)} now.")
+    else:
+        logging.info(f"Found {len(messages)} new message(s) to process.")
+
+    ids, subjects, senders, snippets, replies = [], [], [], [], []
+    for email in fetch_message_metadata(service, [msg['id'] for msg in messages]):
+        headers = {h['name']: h['value'] for h in email['payload']['headers']}
+        ids.append(email['id'])
+        subjects.append(headers.get('Subject', '[No Subject]'))
+        senders.append(headers.get('From', '[No Sender]'))
+        snippets.append(email['snippet'])
+        # In-Reply-To is sender-controlled; only trust it if Gmail threaded the message onto
+        # an existing conversation (the first message of a thread has threadId == id).
+        replies.append('In-Reply-To' in headers and email['threadId'] != email['id'])
+
+    trusted, obvious_ham, obvious_spam, to_classify = [], [], [], []
+    for i, sender in enumerate(senders):
+        if _TRUSTED_RE.search(sender):
+            trusted.append(i)
+        elif replies[i]:
+            obvious_ham.append(i)
+        elif is_obvious_spam(sender, snippets[i]):
+            obvious_spam.append(i)
+        else:
+            to_classify.append(i)
+
+    for i in trusted:
+        logging.info(f"TRUSTED: '{subjects[i]}' from {senders[i]}")
+    for i in obvious_ham:
+        logging.info(f"REPLY: '{subjects[i]}' from {senders[i]}")
+    for i in obvious_spam:
+        logging.warning(f"SPAM (heuristic): '{subjects[i]}' from {senders[i]}")
+    if trusted:
+        processed_ids.update(ids[i] for i in trusted)
+        changed = True
+    if changed:
+        save_processed_ids(processed_ids)
+
+    labelled_ids = [ids[i] for i in obvious_ham]
+    spam_ids = [ids[i] for i in obvious_spam]
+
+    if to_classify:
+        spam_probabilities = classifier.get_email_spam_probabilities_batch(
+            [(subjects[i], senders[i], snippets[i]) for i in to_classify]
+        )
+
+        for i, spam_probability in zip(to_classify, spam_probabilities):
+            if spam_probability > SPAM_CONFIDENCE_THRESHOLD:
+                logging.warning(f"SPAM ({spam_probability:.2%}): '{subjects[i]}'")
+                spam_ids.append(ids[i])
+            else:
+                logging.info(f"NOT SPAM ({spam_probability:.2%}): '{subjects[i]}'")
+                labelled_ids.append(ids[i])
+
+    futures = []
+    if spam_ids:
+        futures.append(submit_label_update(executor, creds, spam_ids, ['SPAM'], ['INBOX']))
+    if labelled_ids:
+        futures.append(submit_label_update(executor, creds, labelled_ids, [processed_label_id], []))
+    return futures, remaining
+
+
+def start_watch(service):
+    """Asks Gmail to publish inbox change notifications to the configured Pub/Sub topic."""
+    response = service.users().watch(
+        userId='me',
+        body={'labelIds': ['INBOX'], 'topicName': PUBSUB_TOPIC}
+    ).execute()
+    logging.info(f"Watching inbox via '{PUBSUB_TOPIC}' (historyId {response.get('historyId')})")
+
+
+def watch_gmail(service, classifier: SpamClassifier, processed_label_id: str,
+                executor: ThreadPoolExecutor, creds: Credentials, processed_ids: set):
+    """
+    Processes new messages whenever Gmail publishes a change notification to Pub/Sub.
+    Returns if the subscriber stops, so the caller can fall back to polling.
+    """
+    from google.cloud import pubsub_v1
+
+    new_mail = threading.Event()
+
+    def on_notification(message):
+        message.ack()
+        new_mail.set()
+
+    subscriber = pubsub_v1.SubscriberClient()
+    streaming_pull = subscriber.subscribe(PUBSUB_SUBSCRIPTION, callback=on_notification)
+    # Wake the loop if the subscriber dies so it does not wait until the next renewal.
+    streaming_pull.add_done_callback(lambda _: new_mail.set())
+    logging.info(f"Listening for notifications on '{PUBSUB_SUBSCRIPTION}'")
+
+    # Catch up on anything that arrived while we were not listening.
+    new_mail.set()
+    watch_expires_at = 0.0
+    pending = []
+    try:
+        while True:
+            if streaming_pull.done():
+                logging.error(f"Pub/Sub subscriber stopped: {streaming_pull.exception()}. "
+                              f"Falling back to polling.")
+                wait_for_label_updates(pending)
+                return
+
+            try:
+                if time.time() >= watch_expires_at:
+                    start_watch(service)
+                    watch_expires_at = time.time() + WATCH_RENEWAL_SECONDS
+
+                if new_mail.wait(timeout=watch_expires_at - time.time()) and not streaming_pull.done():
+                    new_mail.clear()
+                    # Let earlier label updates land so those messages are not listed again.
+                    wait_for_label_updates(pending)
+                    pending, remaining = process_new_messages(
+                        service, classifier, processed_label_id, executor, creds, processed_ids
+                    )
+                    if remaining:
+                        time.sleep(BACKLOG_DELAY_SECONDS)
+                        new_mail.set()
+            except HttpError as e:
+                logging.error(f"An API error occurred: {e}")
+                # Retry, as mail that was waiting may not have been handled.
+                new_mail.set()
+                time.sleep(POLL_INTERVAL_SECONDS)
+            except Exception as e:
+                logging.error(f"An unexpected error occurred: {e}", exc_info=True)
+                new_mail.set()
+                time.sleep(POLL_INTERVAL_SECONDS)
+    finally:
+        streaming_pull.cancel()
+        subscriber.close()
+
+
 def poll_gmail(classifier: SpamClassifier):
     """Main loop to poll Gmail, classify emails, and take action."""
     creds = get_credentials()
@@ -89,52 +376,32 @@ def poll_gmail(classifier: SpamClassifier):
         logging.error("Could not obtain credentials. Exiting.")
         return
 
-    service = build('gmail', 'v1', credentials=creds)
+    service = build_gmail_service(creds)
     processed_label_id = ensure_processed_label(service)
     if not processed_label_id:
         logging.error("Could not obtain or create a processing label. Exiting.")
         return
 
-    while True:
-        try:
-            query = f'is:unread -label:{PROCESSED_LABEL_NAME}'
-            response = service.users().messages().list(userId='me', q=query).execute()
-            messages = response.get('messages', [])
-
-            if not messages:
-                logging.info("No new unread messages. Waiting...")
-            else:
-                logging.info(f"Found {len(messages)} new message(s) to process.")
-
-            for msg in messages:
-                email = service.users().messages().get(userId='me', id=msg['id'], format='metadata').execute()
-
-                headers = {h['name']: h['value'] for h in email['payload']['headers']}
-                subject = headers.get('Subject', '[No Subject]')
-                sender = headers.get('From', '[No Sender]')
-                snippet = email['snippet']
-
-                if any(domain in sender.lower() for domain in TRUSTED_DOMAINS):
-                    logging.info(f"TRUSTED: '{subject}' from {sender}")
-                    modify_message_labels(service, email['id'], [processed_label_id], [])
-                    continue
-
-                text_to_classify = f"Subject: {subject} From: {sender} Body: {snippet}"
-                spam_probability = classifier.get_spam_probability(text_to_classify)
+    processed_ids = load_processed_ids()
+    with ThreadPoolExecutor(max_workers=LABEL_UPDATE_WORKERS) as executor:
+        if PUBSUB_TOPIC and PUBSUB_SUBSCRIPTION:
+            watch_gmail(service, classifier, processed_label_id, executor, creds, processed_ids)
 
-                if spam_probability > SPAM_CONFIDENCE_THRESHOLD:
-                    logging.warning(f"SPAM ({spam_probability:.2%}): '{subject}'")
-                    modify_message_labels(service, email['id'], ['SPAM'], ['INBOX'])
-                else:
-                    logging.info(f"NOT SPAM ({spam_probability:.2%}): '{subject}'")
-                    modify_message_labels(service, email['id'], [processed_label_id], [])
-
-        except HttpError as e:
-            logging.error(f"An API error occurred: {e}")
-        except Exception as e:
-            logging.error(f"An unexpected error occurred: {e}", exc_info=True)
+        pending = []
+        while True:
+            remaining = 0
+            try:
+                # Let earlier label updates land so those messages are not listed again.
+                wait_for_label_updates(pending)
+                pending, remaining = process_new_messages(
+                    service, classifier, processed_label_id, executor, creds, processed_ids
+                )
+            except HttpError as e:
+                logging.error(f"An API error occurred: {e}")
+            except Exception as e:
+                logging.error(f"An unexpected error occurred: {e}", exc_info=True)
 
-        time.sleep(POLL_INTERVAL_SECONDS)
+            time.sleep(BACKLOG_DELAY_SECONDS if remaining else POLL_INTERVAL_SECONDS)
 
 
 if __name__ == "__main__":
@@ -2,14 +2,20 @@ from transformers import AutoTokenizer, AutoModelForSequenceClassification
 import torch
 import os
 import logging
-from typing import List
+from collections import OrderedDict
+from typing import Callable, List, Optional, Tuple
 
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
 )
 
-DEFAULT_MODEL_NAME = "mariagrandury/roberta-base-finetuned-sms-spam-detection"
+DEFAULT_MODEL_NAME = "mariagrandury/distilbert-base-uncased-finetuned-sms-spam-detection"
+CASCADE_MODEL_NAME = "mariagrandury/roberta-base-finetuned-sms-spam-detection"
+DEFAULT_UNCERTAIN_RANGE = (0.5, 0.99)
+DEFAULT_CACHE_SIZE = 4096
+DEFAULT_MAX_LENGTH = 128
+DEFAULT_BATCH_SIZE = 32
 
 
 class SpamClassifier:
@@ -18,26 +24,174 @@ class SpamClassifier:
     Handles model loading, device placement, and inference.
     """
 
-    def __init__(self, model_name: str = DEFAULT_MODEL_NAME):
+    def __init__(self, model_name: str = DEFAULT_MODEL_NAME, quantize: bool = True,
+                 cache_size: int = DEFAULT_CACHE_SIZE, compile_model: bool = True,
+                 max_length: int = DEFAULT_MAX_LENGTH, batch_size: int = DEFAULT_BATCH_SIZE,
+                 cascade_model_name: Optional[str] = None,
+                 uncertain_range: Tuple[float, float] = DEFAULT_UNCERTAIN_RANGE,
+                 cuda_graph: bool = False):
         """
         Initializes the tokenizer and model.
 
         Args:
             model_name (str): The name of the pre-trained model from Hugging Face Hub.
+            quantize (bool): Whether to apply dynamic INT8 quantization to the model's
+                linear layers. Only supported on CPU; ignored on CUDA.
+            cache_size (int): The maximum number of texts whose probabilities are cached.
+            compile_model (bool): Whether to compile the model with torch.compile. Only applies
+                on CPU with quantize=False or on CUDA with cuda_graph=False. If the compiled model
+                fails its warmup forward, the eager model is used instead.
+            max_length (int): The maximum number of tokens per text; longer inputs are truncated.
+            batch_size (int): The maximum number of texts passed to the model at once.
+            cascade_model_name (Optional[str]): The name of a larger model used to re-score
+                texts the primary model is unsure about, e.g. CASCADE_MODEL_NAME. Disabled if None.
+            uncertain_range (Tuple[float, float]): Probabilities strictly inside this range
+                are re-scored by the cascade model.
+            cuda_graph (bool): Whether to capture the forward pass as a CUDA graph for a fixed
+                (batch_size, max_length) input shape and replay it on every call. Only used on
+                CUDA, where the model is then loaded with eager attention and not compiled with
+                torch.compile. If capture fails or replay does not match the eager model, the
+                graph is discarded. Off by default.
         """
         self.model_name = model_name
+        self.quantize = quantize
+        self.cache_size = cache_size
+        self.compile_model = compile_model
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.uncertain_range = uncertain_range
+        self.cuda_graph = cuda_graph
+        self._cache: OrderedDict[str | Tuple[str, str, str], float] = OrderedDict()
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         logging.info(f"SpamClassifier using device: {self.device}")
 
+        torch.set_float32_matmul_precision('high')
+        self._autocast_dtype = torch.float32
+        if self.device.type == 'cuda':
+            # Pre-Ampere GPUs (e.g. T4) emulate BF16 but have FP16 tensor cores.
+            self._autocast_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+
         try:
             self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
-            self.model = AutoModelForSequenceClassification.from_pretrained(self.model_name)
+            self._subject_ids = self.tokenizer("Subject:", add_special_tokens=False)['input_ids']
+            self._from_ids = self.tokenizer(" From:", add_special_tokens=False)['input_ids']
+            self._body_ids = self.tokenizer(" Body:", add_special_tokens=False)['input_ids']
+            use_graph = self.cuda_graph and self.device.type == 'cuda'
+            # SDPA decides whether to apply the mask on the host, which cannot be captured.
+            model_kwargs = {'attn_implementation': 'eager'} if use_graph else {}
+            self.model = AutoModelForSequenceClassification.from_pretrained(self.model_name, **model_kwargs)
+            quantized = self.quantize and self.device.type == 'cpu'
+            if quantized:
+                self.model = torch.ao.quantization.quantize_dynamic(
+                    self.model, {torch.nn.Linear}, dtype=torch.qint8
+                )
+                logging.info("SpamClassifier using dynamic INT8 quantization")
             self.model.to(self.device)
             self.model.eval()
+            self._graph = None
+            if use_graph:
+                self._capture_cuda_graph()
+            if self._graph is None and self.compile_model and not quantized:
+                self._compile_model()
         except Exception as e:
             logging.error(f"Failed to load model '{self.model_name}'. Error: {e}")
             raise
 
+        self.cascade = None
+        if cascade_model_name:
+            # Results are cached by this classifier, so the cascade does not keep its own cache.
+            self.cascade = SpamClassifier(
+                cascade_model_name, quantize=quantize, cache_size=0, compile_model=compile_model,
+                max_length=max_length, batch_size=batch_size, cuda_graph=cuda_graph
+            )
+
+    def _compile_model(self):
+        """
+        Compiles the model with torch.compile and runs a warmup forward, so that compile
+        failures (e.g. a missing C++ toolchain) surface here and fall back to eager mode.
+        """
+        mode = 'reduce-overhead' if self.device.type == 'cuda' else 'default'
+        eager_model = self.model
+        self.model = torch.compile(eager_model, mode=mode, dynamic=True, fullgraph=False)
+        try:
+            warmup_ids = self._encode_texts(["Subject: warmup"])
+            with torch.inference_mode():
+                self._forward(torch.tensor(warmup_ids, device=self.device),
+                              torch.ones(1, len(warmup_ids[0]), dtype=torch.long, device=self.device))
+        except Exception as e:
+            logging.warning(f"torch.compile failed, using the eager model instead. Error: {e}")
+            self.model = eager_model
+            return
+        logging.info(f"SpamClassifier compiled model with torch.compile (mode={mode})")
+
+    def _capture_cuda_graph(self):
+        """
+        Captures the forward pass for a fixed (batch_size, max_length) input shape as a
+        CUDA graph. Inputs are copied into the static tensors and the graph is replayed,
+        avoiding per-kernel launch overhead. The graph is discarded if capture fails or
+        if replaying a padded partial batch does not match the eager model.
+        """
+        shape = (self.batch_size, self.max_length)
+        try:
+            with torch.inference_mode():
+                self._static_input_ids = torch.full(shape, self.tokenizer.pad_token_id,
+                                                    dtype=torch.long, device=self.device)
+                # Capture with padding present so the recorded graph applies the mask.
+                self._static_attention_mask = torch.ones(shape, dtype=torch.long, device=self.device)
+                self._static_attention_mask[:, self.max_length // 2:] = 0
+
+                # Warm up on a side stream, as required before capture.
+                stream = torch.cuda.Stream()
+                stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(stream):
+                    for _ in range(3):
+                        self._forward(self._static_input_ids, self._static_attention_mask)
+                torch.cuda.current_stream().wait_stream(stream)
+
+                self._graph = torch.cuda.CUDAGraph()
+                with torch.cuda.graph(self._graph):
+                    self._static_logits = self._forward(self._static_input_ids, self._static_attention_mask)
+
+            if not self._graph_matches_eager():
+                raise RuntimeError("CUDA graph replay does not match the eager model")
+        except Exception as e:
+            logging.warning(f"CUDA graph capture failed, using the eager model instead. Error: {e}")
+            self._graph = None
+            return
+        logging.info(f"SpamClassifier captured CUDA graph for input shape {shape}")
+
+    def _graph_matches_eager(self) -> bool:
+        """Checks that replaying a padded partial batch gives the same logits as the eager model."""
+        encodings = self._encode_texts([
+            "Subject: lunch",
+            "Subject: Congratulations! You've won a free ticket. Click here to claim your prize now.",
+        ])
+        padded = self.tokenizer.pad({'input_ids': encodings}, padding='max_length',
+                                    max_length=self.max_length, return_tensors="pt")
+        unpadded = self.tokenizer.pad({'input_ids': encodings}, padding=True, return_tensors="pt")
+        with torch.inference_mode():
+            replayed = self._replay_graph(padded['input_ids'], padded['attention_mask']).float()
+            eager = self._forward(unpadded['input_ids'].to(self.device),
+                                  unpadded['attention_mask'].to(self.device)).float()
+        return torch.allclose(replayed, eager, atol=5e-2)
+
+    def _replay_graph(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        """Copies up to batch_size rows of (rows, max_length) inputs into the graph and replays it."""
+        rows = input_ids.shape[0]
+        self._static_input_ids[:rows].copy_(input_ids, non_blocking=True)
+        self._static_attention_mask[:rows].copy_(attention_mask, non_blocking=True)
+        # Unused rows hold pad tokens; their logits are discarded.
+        self._static_input_ids[rows:].fill_(self.tokenizer.pad_token_id)
+        self._static_attention_mask[rows:].fill_(1)
+        self._graph.replay()
+        return self._static_logits[:rows]
+
+    def _forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        """Runs the model and returns its logits."""
+        with torch.autocast(device_type=self.device.type, dtype=self._autocast_dtype,
+                            enabled=self.device.type == 'cuda'):
+            return self.model(input_ids=input_ids, attention_mask=attention_mask).logits
+
     def get_spam_probability(self, text: str) -> float:
         """
         Calculates the spam probability for a single piece of text.
@@ -53,7 +207,8 @@ class SpamClassifier:
     def get_spam_probabilities_batch(self, texts: List[str]) -> List[float]:
         """
         Calculates spam probabilities for a batch of texts. This is more efficient
-        for processing multiple emails at once.
+        for processing multiple emails at once. Texts that have been classified
+        before are served from an in-memory LRU cache without running the model.
 
         Args:
             texts (List[str]): A list of texts to classify.
@@ -61,25 +216,136 @@ class SpamClassifier:
         Returns:
             List[float]: A list of spam probabilities corresponding to each input text.
         """
-        try:
-            inputs = self.tokenizer(
-                texts,
-                return_tensors="pt",
-                truncation=True,
-                padding=True,
-                max_length=512
+        cascade_encode = self.cascade._encode_texts if self.cascade else None
+        return self._get_cached_probabilities(texts, self._encode_texts, cascade_encode)
+
+    def get_email_spam_probabilities_batch(self, emails: List[Tuple[str, str, str]]) -> List[float]:
+        """
+        Calculates spam probabilities for a batch of emails. Each email is classified
+        as "Subject: <subject> From: <sender> Body: <snippet>", but only the variable
+        fields are tokenized; the fixed prefixes are tokenized once at startup.
+
+        Args:
+            emails (List[Tuple[str, str, str]]): A list of (subject, sender, snippet) tuples.
+
+        Returns:
+            List[float]: A list of spam probabilities corresponding to each input email.
+        """
+        cascade_encode = self.cascade._encode_emails if self.cascade else None
+        return self._get_cached_probabilities(emails, self._encode_emails, cascade_encode)
+
+    def _get_cached_probabilities(self, keys: list, encode: Callable[[list], List[List[int]]],
+                                  cascade_encode: Optional[Callable[[list], List[List[int]]]] = None
+                                  ) -> List[float]:
+        """
+        Looks up each key in the cache and runs the model only on the misses. If
+        `cascade_encode` is given, misses with an uncertain probability are encoded
+        with it and re-scored by the cascade model. If the cascade fails, the primary
+        probabilities are kept but not cached, so those keys are retried next time.
+        """
+        results = {}
+        misses = []
+        for key in keys:
+            if key in results:
+                continue
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                results[key] = self._cache[key]
+            else:
+                results[key] = None
+                misses.append(key)
+
+        if misses:
+            try:
+                spam_probabilities = self._predict_batch(encode(misses))
+            except Exception as e:
+                logging.error(f"Error during batch classification: {e}")
+                return [0.0] * len(keys)
+
+            uncached = set()
+            if cascade_encode:
+                low, high = self.uncertain_range
+                uncertain = [i for i, p in enumerate(spam_probabilities) if low < p < high]
+                if uncertain:
+                    try:
+                        refined = self.cascade._predict_batch(cascade_encode([misses[i] for i in uncertain]))
+                        for i, probability in zip(uncertain, refined):
+                            spam_probabilities[i] = probability
+                    except Exception as e:
+                        logging.error(f"Error during cascade classification: {e}")
+                        uncached.update(uncertain)
+
+            for i, (key, probability) in enumerate(zip(misses, spam_probabilities)):
+                results[key] = probability
+                if i not in uncached:
+                    self._cache[key] = probability
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        return [results[key] for key in keys]
+
+    def _encode_texts(self, texts: List[str]) -> List[List[int]]:
+        """Tokenizes free-form texts into truncated input ids with special tokens."""
+        return self.tokenizer(
+            texts,
+            truncation=True,
+            max_length=self.max_length
+        )['input_ids']
+
+    def _encode_emails(self, emails: List[Tuple[str, str, str]]) -> List[List[int]]:
+        """
+        Builds input ids for (subject, sender, snippet) tuples from the cached prefix
+        ids and the tokenized fields. Each field is tokenized with a leading space so
+        the result matches tokenizing the joined string.
+        """
+        fields = [' ' + field for email in emails for field in email]
+        field_ids = self.tokenizer(fields, add_special_tokens=False)['input_ids']
+
+        encodings = []
+        for i in range(len(emails)):
+            subject_ids, sender_ids, snippet_ids = field_ids[3 * i:3 * i + 3]
+            ids = (self._subject_ids + subject_ids + self._from_ids + sender_ids
+                   + self._body_ids + snippet_ids)
+            ids = ids[:self.max_length - 2]
+            encodings.append([self.tokenizer.cls_token_id] + ids + [self.tokenizer.sep_token_id])
+        return encodings
+
+    def _predict_batch(self, encodings: List[List[int]]) -> List[float]:
+        """
+        Runs the model over a batch of encoded inputs, bypassing the cache. Inputs are
+        sorted by token count and split into sub-batches so that each sub-batch is
+        padded only to the length of its own longest input. When a CUDA graph has been
+        captured (see cuda_graph), every sub-batch is instead padded to the static
+        (batch_size, max_length) shape, so the length bucketing has no effect there.
+        """
+        order = sorted(range(len(encodings)), key=lambda i: len(encodings[i]))
+
+        spam_probabilities = [0.0] * len(encodings)
+        for start in range(0, len(order), self.batch_size):
+            chunk = order[start:start + self.batch_size]
+            inputs = self.tokenizer.pad(
+                {'input_ids': [encodings[i] for i in chunk]},
+                padding='max_length' if self._graph is not None else True,
+                max_length=self.max_length,
+                return_tensors="pt"
             )
-            inputs = {k: v.to(self.device) for k, v in inputs.items()}
+            if self.device.type == 'cuda':
+                inputs = {k: v.pin_memory() for k, v in inputs.items()}
 
-            with torch.no_grad():
-                outputs = self.model(**inputs)
-                predictions = torch.nn.functional.softmax(outputs.logits, dim=-1)
+            with torch.inference_mode():
+                if self._graph is not None:
+                    logits = self._replay_graph(inputs['input_ids'], inputs['attention_mask'])
+                else:
+                    inputs = {k: v.to(self.device, non_blocking=True) for k, v in inputs.items()}
+                    logits = self._forward(inputs['input_ids'], inputs['attention_mask'])
+                # For two classes, softmax(logits)[:, 1] == sigmoid(logits[:, 1] - logits[:, 0]).
+                logits = logits.float()
+                predictions = torch.sigmoid(logits[:, 1] - logits[:, 0]).cpu()
 
-            spam_probabilities = predictions[:, 1].tolist()
-            return spam_probabilities
-        except Exception as e:
-            logging.error(f"Error during batch classification: {e}")
-            return [0.0] * len(texts)
+            for i, probability in zip(chunk, predictions.tolist()):
+                spam_probabilities[i] = probability
+
+        return spam_probabilities
 
 
 if __name__ == "__main__":
@@ -108,6 +374,18 @@ if __name__ == "__main__":
         status = "SPAM" if prob > 0.95 else "NOT SPAM"
         print(f"Probability: {prob:.2%} [{status}] - Text: \"{single_test[:50]}...\"")
 
+        print("\n--- Testing Email Classification ---")
+        email_test = ("You've won a free cruise!", "Prize Team <claims@prizes.example>",
+                      "Reply within 24 hours to claim your reward.")
+        joined_test = f"Subject: {email_test[0]} From: {email_test[1]} Body: {email_test[2]}"
+        email_prob = spam_classifier.get_email_spam_probabilities_batch([email_test])[0]
+        joined_prob = spam_classifier.get_spam_probabilities_batch([joined_test])[0]
+        ids_match = spam_classifier._encode_emails([email_test]) == spam_classifier._encode_texts([joined_test])
+        status = "SPAM" if email_prob > 0.95 else "NOT SPAM"
+        print(f"Probability: {email_prob:.2%} [{status}] - Email: \"{email_test[0][:50]}...\"")
+        print(f"Matches joined text: input ids {ids_match}, "
+              f"probabilities {abs(email_prob - joined_prob) < 1e-4} ({joined_prob:.2%})")
+
     except Exception as e:
         print(f"\n--- Test Failed ---")
         print(f"An error occurred during initialization or testing: {e}")